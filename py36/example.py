@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
-from intern.intern import Intern
+import warnings
+
+from intern.intern import Intern, TupleFields
 from intern.internable import Internable
 
 @Intern
@@ -31,3 +33,32 @@ colorB2 = ColorB.MakeInterned(1.0, 0.0, 0.0)
 colorB3 = ColorB(1.0, 0.0, 0.0)
 print("colorB2 is colorB1?", colorB2 is colorB1)
 print("colorB3 is colorB1?", colorB3 is colorB1)
+print("colorB1 is interned?", colorB1.isInterned())
+print("colorB3 is interned?", colorB3.isInterned())
+
+colorsA = ColorA.MakeInternedMany([(1.0, 0.0, 0.0), (1.0, 1.0, 0.0)])
+print("colorsA[0] is colorA1?", colorsA[0] is colorA1)
+print("colorsA[1] is colorA3?", colorsA[1] is colorA3)
+
+colorsB = ColorB.MakeInternedMany([(1.0, 0.0, 0.0), (0.0, 0.0, 1.0)])
+print("colorsB[0] is colorB1?", colorsB[0] is colorB1)
+
+@Intern
+@TupleFields("r", "g", "b")
+class ColorC:
+	pass
+
+colorC1 = ColorC(1.0, 0.0, 0.0)
+colorC2 = ColorC(r=1.0, g=0.0, b=0.0)
+print("colorC2 is colorC1?", colorC2 is colorC1)
+print("colorC1.r:", colorC1.r)
+
+# A class with no astuple() and object identity for equality and hashing is
+# left as is, with a warning, since none of its instances would ever match.
+with warnings.catch_warnings(record=True) as caught:
+	warnings.simplefilter("always")
+	@Intern
+	class Plain:
+		pass
+print("Plain left uninterned with a warning?", bool(caught))
+print("Plain has MakeInternedMany?", hasattr(Plain, "MakeInternedMany"))
@@ -1,162 +1,469 @@
-from collections.abc import ItemsView, Iterable, Iterator
-from typing import Any, ClassVar, Union
+from collections.abc import ItemsView, Iterable
+from typing import Any, Callable, ClassVar, Dict, Optional, Tuple, Union
 from threading import Lock
-from weakref import ref
+from weakref import KeyedRef, ref
+import sys
+import warnings
+
+try:
+    # This is the same helper WeakValueDictionary uses. It atomically
+    # deletes dct[key] provided it is still a dead weak reference.
+    from _weakref import _remove_dead_weakref
+except ImportError:
+    # Python 3.6.0 and older lack the helper, so we make do with a lock.
+    # Entries only ever get deleted here, so the lock alone is enough to
+    # keep one thread from deleting a live entry another thread has just
+    # installed in place of a dead one.
+    _gRemoveLock = Lock()
+
+    def _remove_dead_weakref(dct: dict, key: Any):
+        with _gRemoveLock:
+            wkRef = dct.get(key)
+            if wkRef is not None and wkRef() is None:
+                del dct[key]
+
+# The internment table is split into shards. Each shard is an internment
+# dict mapping key tuples onto weak references to interned objects, paired
+# with the callback those references use to remove their entry once their
+# object dies. (On free-threaded builds of Python, every dict has a lock of
+# its own, so sharding keeps threads interning unrelated objects from
+# contending for the same one.)
+_Shard = Tuple[Dict[tuple, KeyedRef], Callable[[KeyedRef], None]]
+_Shards = Tuple[_Shard, ...]
 
 
 class _details:
     # A class used as a namespace to hide implementation details.
 
+    # The number of shards in the internment table. It must be a power of 2.
+    # With a GIL, threads never contend for a dict's lock anyway (there is
+    # none), so a single shard saves both memory and the hash that picking
+    # one costs.
+    NUM_SHARDS: ClassVar[int] = (
+        1 if getattr(sys, "_is_gil_enabled", lambda: True)() else 64
+    )
+
+    @classmethod
+    def MakeShards(cls) -> _Shards:
+        # Returns: an empty internment table (see _gShards)
+        return tuple(cls.MakeShard() for _ in range(cls.NUM_SHARDS))
+
+    @classmethod
+    def MakeShard(cls) -> _Shard:
+        # Returns: an empty internment table shard
+        dct = {}
+
+        def removeRef(wkRef: KeyedRef):
+            _remove_dead_weakref(dct, wkRef.key)
+
+        return dct, removeRef
+
+    @classmethod
+    def ShardFor(cls, tup: tuple) -> _Shard:
+        # Args:
+        #     tup: a key tuple as returned by KeyTuple()
+        # Returns: the (dict, callback) shard of the table tup belongs in
+        if len(_gShards) == 1:
+            return _gShards[0]
+        return _gShards[hash(tup) & (len(_gShards) - 1)]
+
+    # Built-in scalar types, which KeyTuple() always treats as leaves:
+    # neither containers it recurses into nor classes with an astuple()
+    # method. Other types take MakeTuple()'s slower path even when they turn
+    # out to be leaves, since remembering them would keep them alive.
+    __gLeafTypes: ClassVar[frozenset] = frozenset(
+        (int, float, complex, bool, str, bytes, type(None))
+    )
+
     @classmethod
     def KeyTuple(cls, obj: Any, recursing: bool = False) -> tuple:
         # Given an object, returns a tuple representing its data that can
         # (hopefully!) be hashed and equality-compared for the sake of using
         # it as a dict key.
         #
+        # The tuple is a (values, types) pair. Keeping the data and their
+        # types apart this way means a flat sequence of plain values can
+        # be keyed without wrapping each value in a tuple of its own (see
+        # MakeTuple()).
+        #
         # Args:
         #     obj: an object
         #     recursing: is this a recursive call to KeyTuple()?
         # Returns: a tuple representing obj data
 
-        def genElems(
-            ctnr: Union[ItemsView, Iterable], typ: type
-        ) -> Iterator[Any]:
-            # Given some sort of container, genElems() calls KeyTuple
-            # recursively on its elements. It also yields the object type at
-            # the end. The type is important because we do not want to intern
-            # 2 objects of different types, even if their data turn out to be
-            # equal.
-            for elem in ctnr:
-                yield cls.KeyTuple(elem, recursing=True)
-            yield typ
-
-        def makeTuple(seq: Union[ItemsView, Iterable], typ: type) -> tuple:
-            # makeTuple() simply returns a tuple formed out of the elements
-            # yielded by genElems().
-            return tuple(genElems(seq, typ))
-
         typ = type(obj)
 
-        # First attempt to call obj's astuple() method.
+        # First, we check to see if obj is a common container type. (At this
+        # point, we are only dealing with the types you might encounter from
+        # a Python 3.7+ dataclass's astuple() method. More types may be
+        # supported in the future.) These exact types cannot have an
+        # astuple() method, so checking for them first saves a failed
+        # attribute lookup on every container.
+        if typ is list or typ is tuple:
+            return cls.MakeTuple(obj, typ)
+
+        # In the case of a dict, we convert it to a tuple of tuples, where
+        # the inner tuples are key-value pairs as accessed through the dict
+        # items() method.
+        if typ is dict:
+            return cls.MakeTuple(obj.items(), typ)
+
+        # Next, attempt to call obj's astuple() method.
         try:
             tup = obj.astuple()
 
         except AttributeError:
 
-            # Evidently, there is no astuple() method. Next, we check to see
-            # obj is a common container type. (At this point, we are only
-            # dealing with the types you might encounter from a Python 3.7+
-            # dataclass's astuple() method. More types may be supported in
-            # the future.)
-            if typ in (list, tuple):
-                return makeTuple(obj, typ)
-
-            # In the case of a dict, we convert it to a tuple of tuples
-            # (plus a type element at the end), where the inner tuples are
-            # key-value pairs as accessed through the dict items() method.
-            if typ is dict:
-                return makeTuple(obj.items(), typ)
-
             # At this point, it looks like we are dealing with a black box obj
-            # that we cannot discern any more info about. We will return it in
-            # a tuple along with its data type. If it is the primary object
-            # (as opposed to a subobject being handled by a recursive call to
-            # KeyTuple()), this tuple should contain a weak reference to the
+            # that we cannot discern any more info about. We will return it
+            # along with its data type. If it is the primary object (as
+            # opposed to a subobject being handled by a recursive call to
+            # KeyTuple()), the tuple should contain a weak reference to the
             # object so that it can eventually die when no longer in use
             # outside the internment dict.
-            return (obj if recursing else ref(obj), typ)
+            if not recursing:
+                return (ref(obj), typ)
+            return (obj, typ)
 
         else:
 
             # Even if we already have obj in tuple from (from the astuple()
-            # call), we want to tack on the object's data type (see note
-            # under genElems() regarding this).
-            return makeTuple(tup, typ)
+            # call), we want to pair it with the object's data type (see note
+            # under MakeTuple() regarding this).
+            return cls.MakeTuple(tup, typ)
+
+    @classmethod
+    def MakeTuple(cls, ctnr: Union[ItemsView, Iterable], typ: type) -> tuple:
+        # Given some sort of container, MakeTuple() returns a (values, types)
+        # key tuple for it. The values tuple has an entry for each element
+        # of the container. The types tuple starts with the container type
+        # and then has an entry for each element. The types are important
+        # because we do not want to intern 2 objects of different types, even
+        # if their data turn out to be equal (e.g. 1 and 1.0).
+        #
+        # A leaf element contributes itself to the values and its type to
+        # the types. Any other element gets run through KeyTuple(), and its
+        # own values and types tuples are nested in their place.
+
+        # In the common case where every element is a built-in scalar,
+        # the tuples can be built from C-level operations alone. If ctnr is
+        # already a tuple, it even serves as the values tuple as is.
+        if type(ctnr) is not tuple:
+            ctnr = tuple(ctnr)
+        elemTypes = tuple(map(type, ctnr))
+        leafTypes = cls.__gLeafTypes
+        if leafTypes.issuperset(elemTypes):
+            return (ctnr, (typ,) + elemTypes)
+
+        # Otherwise, we recurse into the non-leaf elements. The elements are
+        # gathered with a list comprehension rather than a generator, since
+        # the comprehension runs in a single frame instead of resuming a
+        # generator frame per element.
+        keyTuple = cls.KeyTuple
+        values, types = zip(*[
+            (elem, elemType) if elemType in leafTypes
+            else keyTuple(elem, True)
+            for elem, elemType in zip(ctnr, elemTypes)
+        ])
+        return (values, (typ,) + types)
 
     @classmethod
-    def RegisterObj(cls, lock: Lock, dct: dict, obj: Any) -> Any:
+    def KeyFunc(cls, typ: type) -> Callable[[Any], tuple]:
+        # Returns a function that is equivalent to KeyTuple() for instances
+        # of a given class (excluding the exact list, tuple and dict types).
+        # Whether the class has an astuple() method is decided here once, so
+        # that the returned function need not probe for it on every call.
+        #
+        # Args:
+        #     typ: the class
+        # Returns: a function mapping an instance of typ onto its key tuple
+        makeTuple = cls.MakeTuple
+
+        if hasattr(typ, "astuple"):
+            def keyTuple(obj: Any) -> tuple:
+                return makeTuple(obj.astuple(), type(obj))
+        else:
+            def keyTuple(obj: Any) -> tuple:
+                return (ref(obj), type(obj))
+
+        return keyTuple
+
+    @classmethod
+    def RegisterObj(cls, obj: Any, tup: Optional[tuple] = None) -> Any:
         # Looks up whether a particular object has already been interned.
         # If so, the previously interned object is returned. Otherwise, the
         # input object is returned once it has been installed in the
-        # internment dictionary.
+        # internment table.
+        #
+        # No lock is needed for this. Each step is a single dict operation
+        # performed in C (which is atomic whether or not the interpreter has
+        # a GIL), and every step copes with what another thread might have
+        # done in between.
+        #
+        # The internment table stores weak references so that an object does
+        # not live on after all references outside the table have expired.
+        # Its entry is removed by the reference's callback at that point.
         #
         # Args:
-        #     lock: used to manage access to dct (which should be a global)
-        #     dct: the internment dictionary
-        #         Maps key tuples onto weak references to interned objects.
         #     obj: the object to register
+        #     tup: the key tuple of obj, if the caller has it already
+        #         Defaults to calling KeyTuple() on obj.
         #
         # Returns: either the input obj or a previously interned equivalent
 
         # Get the object data in tuple form.
-        tup = cls.KeyTuple(obj)
-
-        with lock:
+        if tup is None:
+            tup = cls.KeyTuple(obj)
+        dct, removeRef = cls.ShardFor(tup)
 
-            # Return the interned object, if any, whose key matches the tuple.
-            try:
-                return dct[tup]()
+        # Return the interned object, if any, whose key matches the tuple.
+        # This is by far the most common case: the object has been interned
+        # before.
+        wkRef = dct.get(tup)
+        if wkRef is not None:
+            existing = wkRef()
+            if existing is not None:
+                return existing
 
-            # If the object has yet to be interned, we intern it by adding a
-            # new item to the dictionary. The tuple serves as the key and a
-            # weak reference to the object serves as the value. (Weak
-            # references are appropriate because we do not want the object
-            # to live on after all references outside the internment dict
-            # have expired. In fact, we want the object's __del__() method
-            # to remove it from the dict at that point.)
-            except KeyError:
-                dct[tup] = ref(obj)
-                return obj
+        # Otherwise, obj gets installed under the tuple and returned.
+        # setdefault() leaves any entry another thread has installed in the
+        # meantime alone, in which case the other thread's object is
+        # returned instead. If it turns out to be a dead reference whose
+        # callback has yet to run, we remove it ourselves and try again.
+        newRef = KeyedRef(obj, removeRef, tup)
+        while True:
+            wkRef = dct.setdefault(tup, newRef)
+            if wkRef is newRef:
+                break
+            existing = wkRef()
+            if existing is not None:
+                return existing
+            _remove_dead_weakref(dct, tup)
+        return obj
 
     @classmethod
-    def UnregisterObj(cls, lock: Lock, dct: dict, obj: Any):
-        # This method should get called by the __del__() methods of objects
-        # interned in a given dictionary. It removes the dict entry
-        # corresponding to the object.
-        #
+    def Lookup(cls, tup: tuple) -> Any:
         # Args:
-        #     lock: used to manage access to dct (which should be a global)
-        #     dct: the internment dictionary
-        #     obj: the object to remove from dct
-        tup = cls.KeyTuple(obj)
-        with lock:
+        #     tup: a key tuple as returned by KeyTuple()
+        # Returns: the interned object whose key matches tup, or None
+        wkRef = cls.ShardFor(tup)[0].get(tup)
+        return None if wkRef is None else wkRef()
+
+
+# The internment table shared by all interned objects, whatever their class.
+# (Key tuples include the object type, so objects of different classes never
+# clash.)
+_gShards: _Shards = _details.MakeShards()
+
+
+class _InternedMeta(type):
+    # The metaclass of every class made by the Intern decorator. Interning
+    # happens at the metaclass level. That way, instantiation runs the
+    # decorated class's __new__() and __init__() exactly once, as it
+    # normally would, before the new object is looked up in the internment
+    # table.
+    #
+    # The same metaclass methods serve all interned classes. The one piece of
+    # per-class state is the _intern_key_tuple class attribute: the class's
+    # key function (see KeyFunc()). It is set up for each new class,
+    # including subclasses of the decorated one, since a subclass may add an
+    # astuple() method of its own.
+
+    def __init__(cls, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        cls._intern_key_tuple = staticmethod(_details.KeyFunc(cls))
 
-            # With Internable objects, it's optional to intern but __del__()
-            # will still try to unregister them. So we can't assume the object
-            # will always be there -- hence, the non-exception-throwing pop()
-            # call here.
-            dct.pop(tup, None)
+    def __call__(cls, *args, **kwargs):
+        obj = super().__call__(*args, **kwargs)
+        return _details.RegisterObj(obj, cls._intern_key_tuple(obj))
+
+    def MakeInternedMany(cls, argsIter: Iterable[tuple]) -> list:
+        """
+        Instantiates a batch of interned class objects in one call. This is
+        cheaper than instantiating them one at a time when there are many of
+        them, since the per-object work is done in a single loop rather than
+        a metaclass __call__() per object.
+
+        Args:
+            argsIter: positional args tuples for your class's __init__()
+                One object is made for each tuple.
+
+        Returns:
+            list: the instances of your class, in the order of argsIter
+                As with normal instantiation, each may be an object that was
+                interned earlier.
+        """
+        baseCall = super().__call__
+        registerObj = _details.RegisterObj
+        keyTuple = cls._intern_key_tuple
+        objs = []
+        for args in argsIter:
+            obj = baseCall(*args)
+            objs.append(registerObj(obj, keyTuple(obj)))
+        return objs
+
+
+# Maps the metaclasses of decorated classes onto the _InternedMeta subclasses
+# that have been derived from them.
+_gInternedMetas: Dict[type, type] = {}
+
+
+def _InternedMetaFor(baseMeta: type) -> type:
+    # Args:
+    #     baseMeta: the metaclass of a class being decorated by Intern
+    # Returns: the metaclass to give the interned class
+    if issubclass(_InternedMeta, baseMeta):
+        return _InternedMeta
+    if issubclass(baseMeta, _InternedMeta):
+        return baseMeta
+    try:
+        return _gInternedMetas[baseMeta]
+    except KeyError:
+        meta = type(_InternedMeta)(
+            "_Interned" + baseMeta.__name__, (_InternedMeta, baseMeta), {}
+        )
+        return _gInternedMetas.setdefault(baseMeta, meta)
 
 
 def Intern(baseCls, *args, **kwargs):
     """
     Intern is a class decorator. If you have an immutable class, you can
     decorate it to prevent multiple allocations with the same data.
+
+    The decorated class gets a metaclass that does the interning, derived
+    from the metaclass of the class you decorate. A subclass mixing in a
+    class with some other metaclass, such as an ABC, needs to declare a
+    metaclass deriving from both:
+
+        class Sub(Interned, abc.ABC,
+                  metaclass=type("Meta", (type(Interned), abc.ABCMeta), {})):
+            ...
+
+    A class with no astuple() method that also inherits __eq__() and
+    __hash__() from object cannot be interned, since its instances would
+    never match. Intern warns about it and returns the class unchanged, so
+    it gets none of the interning API (MakeInternedMany() included). Its
+    subclasses are not interned either, even if they add astuple(); decorate
+    those yourself.
+    """
+
+    # Without astuple() and with the equality and hashing it inherits from
+    # object, every instance of baseCls is unique. Internment would never
+    # find a match, and would only slow down instantiation.
+    if not hasattr(baseCls, "astuple") \
+            and baseCls.__eq__ is object.__eq__ \
+            and baseCls.__hash__ is object.__hash__:
+        warnings.warn(
+            "{} has no astuple() method and uses object identity for "
+            "__eq__() and __hash__(), so it is not being interned".format(
+                baseCls.__qualname__
+            ),
+            stacklevel=2,
+        )
+        return baseCls
+
+    ns = {
+        "__module__": baseCls.__module__,
+        "__qualname__": baseCls.__qualname__,
+        "__doc__": baseCls.__doc__,
+    }
+
+    # Without __slots__, the interned class would give every instance a
+    # __dict__ even if baseCls does without one. The one slot it may need is
+    # __weakref__, in case baseCls does not support weak references.
+    # (Variable-sized types like tuple do not allow nonempty __slots__, and
+    # keep the default layout.)
+    if baseCls.__weakrefoffset__:
+        ns["__slots__"] = ()
+    elif not baseCls.__itemsize__:
+        ns["__slots__"] = ("__weakref__",)
+
+    meta = _InternedMetaFor(type(baseCls))
+    return meta(baseCls.__name__, (baseCls,), ns)
+
+
+def TupleFields(*names: str) -> Callable[[type], type]:
     """
+    TupleFields makes a class decorator for immutable classes whose data
+    consist of a fixed set of fields. The decorated class gets an __init__()
+    method that takes the fields as arguments and stores them together in a
+    single tuple, read-only properties to access them by name, and an
+    astuple() method that returns the stored tuple as is. That way, interning
+    an object does not require building a new tuple out of its fields.
+
+        @Intern
+        @TupleFields("r", "g", "b")
+        class Color:
+            pass
+
+    When combined with @Intern, TupleFields must be applied first (i.e. listed
+    below it), so that @Intern sees the astuple() method.
+
+    Args:
+        *names: the field names, in tuple order
 
-    class Interned(baseCls):
-        __gLock: ClassVar = Lock()
-        __gDict: ClassVar[dict] = {}
+    Returns:
+        function: the class decorator
+            Like Intern, it returns a subclass of the class you decorate.
+    """
+    numFields = len(names)
 
-        def __new__(cls, *args, **kwargs):
-            recurse = kwargs.pop("INTERN_RECURSE", True)
-            if recurse:
-                kwargs["INTERN_RECURSE"] = False
-                obj = cls(*args, **kwargs)
-                return _details.RegisterObj(cls.__gLock, cls.__gDict, obj)
-            else:
-                obj = super().__new__(cls)
-            return obj
+    def decorate(cls: type) -> type:
 
         def __init__(self, *args, **kwargs):
-            kwargs.pop("INTERN_RECURSE", None)
-            super().__init__(*args, **kwargs)
+            # The fields can be given positionally or by name, much like
+            # normal function arguments.
+            if kwargs or len(args) != numFields:
+                for name in names[:len(args)]:
+                    if name in kwargs:
+                        raise TypeError(
+                            "{}() got multiple values for field argument "
+                            "'{}'".format(cls.__name__, name)
+                        )
+                missing = names[len(args):]
+                try:
+                    args += tuple(kwargs.pop(name) for name in missing)
+                except KeyError as err:
+                    raise TypeError(
+                        "{}() missing field argument {}".format(
+                            cls.__name__, err
+                        )
+                    ) from None
+                if kwargs:
+                    raise TypeError(
+                        "{}() got an unexpected field argument '{}'".format(
+                            cls.__name__, next(iter(kwargs))
+                        )
+                    )
+                if len(args) != numFields:
+                    raise TypeError(
+                        "{}() takes {} field arguments".format(
+                            cls.__name__, numFields
+                        )
+                    )
+            object.__setattr__(self, "_tuple_fields", args)
+
+        def astuple(self) -> tuple:
+            return self._tuple_fields
+
+        ns = {
+            "__module__": cls.__module__,
+            "__qualname__": cls.__qualname__,
+            "__doc__": cls.__doc__,
+            "__init__": __init__,
+            "astuple": astuple,
+        }
+        for i, name in enumerate(names):
+            ns[name] = property(lambda self, i=i: self._tuple_fields[i])
+
+        # The tuple gets a slot of its own, unless cls is a variable-sized
+        # type that does not allow nonempty __slots__ (see Intern()).
+        if not cls.__itemsize__:
+            ns["__slots__"] = ("_tuple_fields",)
 
-        def __del__(self):
-            _details.UnregisterObj(self.__gLock, self.__gDict, self)
-            try:
-                super().__del__()
-            except AttributeError:
-                pass
+        # Making a subclass, rather than adding methods to cls itself, means
+        # the class creation hooks of Internable and the Intern metaclass
+        # see the astuple() method and key instances by it.
+        return type(cls)(cls.__name__, (cls,), ns)
 
-    return Interned
+    return decorate
@@ -1,6 +1,5 @@
 from .intern import _details
-from typing import ClassVar
-from threading import Lock
+from collections.abc import Iterable
 
 
 class Internable:
@@ -9,13 +8,23 @@ class Internable:
     that inherits from it. Unlike with the intern.Intern decorator approach,
     the internment is not compulsory. Objects only get interned if you call the
     MakeInterned() class method to instantiate them.
+
+    Whether a class keys its instances by astuple() is decided when the class
+    is created, so the method must be defined in the class body (or that of
+    a base class) rather than attached to the class afterwards.
     """
 
     class Immutable(Exception):
         pass
 
-    __gLock: ClassVar[Lock] = Lock()
-    __gDict: ClassVar[dict] = {}
+    # Each subclass gets a key function specialized on whether it has an
+    # astuple() method, so that MakeInterned() need not probe for it on every
+    # call. (Internable itself has none.)
+    _intern_key_tuple = staticmethod(_details.KeyFunc(object))
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._intern_key_tuple = staticmethod(_details.KeyFunc(cls))
 
     @classmethod
     def MakeInterned(cls, *args, **kwargs):
@@ -34,7 +43,33 @@ class Internable:
                 already been deallocated).
         """
         obj = cls(*args, **kwargs)
-        return _details.RegisterObj(cls.__gLock, cls.__gDict, obj)
+        return _details.RegisterObj(obj, cls._intern_key_tuple(obj))
+
+    @classmethod
+    def MakeInternedMany(cls, argsIter: Iterable[tuple]) -> list:
+        """
+        Allocates a batch of interned class objects in one call. This is
+        cheaper than calling MakeInterned() repeatedly when there are many of
+        them, since the lookups it would repeat for each object are done
+        once up front.
+
+        Args:
+            cls (type): your class that inherits from Internable
+            argsIter: positional args tuples for your class's __init__()
+                One object is allocated for each tuple.
+
+        Returns:
+            list: the instances of your class, in the order of argsIter
+                As with MakeInterned(), each may be an object that was
+                interned earlier.
+        """
+        registerObj = _details.RegisterObj
+        keyTuple = cls._intern_key_tuple
+        objs = []
+        for args in argsIter:
+            obj = cls(*args)
+            objs.append(registerObj(obj, keyTuple(obj)))
+        return objs
 
     @classmethod
     def MakeInternable(cls, *args, **kwargs):
@@ -70,9 +105,9 @@ class Internable:
             True if the current object was allocated by MakeInterned().
             False if it was instantiated directly.
         """
-        tup = _details.KeyTuple(self)
-        with self.__gLock:
-            return tup in self.__gDict
+        # An equal object may well be interned, so it is not enough to find a
+        # match for the key tuple. The match has to be this very object.
+        return _details.Lookup(type(self)._intern_key_tuple(self)) is self
 
     def assertMutable(self):
         """
@@ -83,10 +118,3 @@ class Internable:
         """
         if self.isInterned():
             raise self.Immutable("interned objects cannot be modified")
-
-    def __del__(self):
-        """
-        This custom __del__() method unregisters any interned object from the
-        internal dict global once the last reference to it expires.
-        """
-        _details.UnregisterObj(self.__gLock, self.__gDict, self)